@@ -29,9 +29,29 @@ import random
 import datetime
 import subprocess
 import json
+import queue
+import threading
+import time
+import bisect
+import heapq
+import contextlib
+import concurrent.futures
+import struct
 
 from PIL import Image
 
+try:
+    import numpy as np
+except ImportError:
+    # the vectorized batch engine is then not available
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    # not available on windows, the files are then read in the listing order
+    fcntl = None
+
 # options to implement:
 #   dryrun
 #   force, overwrite exsiting files
@@ -41,6 +61,23 @@ from PIL import Image
 __version__ = 0.1
 __author__ = 'Alexander Stark'
 
+# Only photos and videos are renamed. The sidecar files of the camera, like the
+# thumbnails '.THM' and the low resolution videos '.LRV', share the name of
+# their video but have no creation date which could be extracted.
+MEDIA_EXTENSION = r'(\.(?:MP4|mp4|JPG|jpg))\Z'
+
+# the camera writes only ascii digits
+CHAPTER_PATTERN = re.compile(r'GP(\d{2})(\d{4})' + MEDIA_EXTENSION, re.ASCII)
+BURST_PATTERN = re.compile(r'G(\d{3})(\d{4})' + MEDIA_EXTENSION, re.ASCII)
+RECORD_3D_PATTERN = re.compile(r'3D_(R|L)(\d{4})' + MEDIA_EXTENSION, re.ASCII)
+SINGLE_PATTERN = re.compile(r'GOPR(\d{4})' + MEDIA_EXTENSION, re.ASCII)
+
+# group kinds as they are produced by the find_* methods
+CHAPTERED = 'chaptered'
+BURST = 'burst'
+RECORD_3D = '3d'
+SINGLE = 'single'
+
 
 def compile_filename(filename, directory='.'):
 
@@ -251,7 +288,7 @@ def gen_rnd_chap_list(number_of_files=10):
         for jj in range(number_of_sub_chap):
             
             # All the other chapter have the same last digit number
-            filename = 'GP{0:02d}{1:04d}.{2}'.format(jj, rnd_4digit_num, ext_name)
+            filename = 'GP{0:02d}{1:04d}.{2}'.format(jj+1, rnd_4digit_num, ext_name)
             rnd_chap_list.append(filename)
     
     return rnd_chap_list
@@ -347,6 +384,230 @@ def gen_rnd_mix_list(num_of_files=10):
 # Random file list generation to test the find and sort algorithm
 # =============================================================================
 
+# =============================================================================
+# Seeded, lazy generation of realistic card layouts
+
+# relative frequencies of the group kinds on a card
+DEFAULT_CAMERA_MIX = ((SINGLE, 0.55), (CHAPTERED, 0.2), (BURST, 0.15),
+                      (RECORD_3D, 0.1))
+
+# the camera counts the file number <zzzz> and the group number <yyy> up to
+MAX_FILE_NUMBER = 9999
+MAX_GROUP_NUMBER = 999
+
+SIDECAR_EXTENSIONS = ('THM', 'LRV')
+
+
+def iter_rnd_card_groups(number_of_groups, seed=None, camera_mix=DEFAULT_CAMERA_MIX,
+                         max_chapters=10, max_burst=30, missing_chapter_prob=0.0,
+                         sidecar_prob=0.0, gap_prob=0.05):
+    """ Generate lazily the groups of realistic GoPro card layouts.
+
+    In contrast to the gen_rnd_* methods, the names follow the counters of
+    the camera: each file number <zzzz> is used only once per folder, the
+    chapters of a video are contiguous starting with 01 and a burst takes
+    consecutive file numbers. Once a counter runs out, the camera continues
+    in the next folder '101GOPRO', '102GOPRO', ... Only the current group is
+    kept in memory, so millions of names can be produced with constant
+    memory. The same seed produces always the same names.
+
+    Parameters
+    ----------
+    number_of_groups : int
+        number of groups (videos, photos, bursts, 3D records) to generate
+    seed : int
+        seed for the random generator, None for a random seed
+    camera_mix : tuple
+        pairs of (kind, weight) with the relative frequency of each kind
+    max_chapters : int
+        maximal number of chapters GP<xx> following the first video
+    max_burst : int
+        maximal number of files in a burst
+    missing_chapter_prob : float
+        probability that one file of a chaptered video is missing
+    sidecar_prob : float
+        probability that a video comes with its '.THM' and '.LRV' files
+    gap_prob : float
+        probability that a file number is skipped, e.g. by a deleted file
+
+    Returns
+    -------
+    generator
+        yielding tuples (folder, kind, key, media_names, sidecar_names),
+        where key is the key of the group in the dicts of the find_* methods
+        (for single items the filename itself).
+    """
+
+    rng = random.Random(seed)
+    kinds = [kind for kind, weight in camera_mix]
+    cum_weights = []
+    total = 0
+    for kind, weight in camera_mix:
+        total += weight
+        cum_weights.append(total)
+
+    folder_number = 100
+    file_number = 0
+    group_number = 0
+
+    for ii in range(number_of_groups):
+
+        kind = rng.choices(kinds, cum_weights=cum_weights)[0]
+
+        if kind == CHAPTERED:
+            # most recordings are short, so the number of chapters decays
+            number_of_files = 2
+            while number_of_files <= max_chapters and rng.random() < 0.5:
+                number_of_files += 1
+        elif kind == BURST:
+            number_of_files = rng.randint(2, max_burst)
+        else:
+            number_of_files = 1
+
+        if rng.random() < gap_prob:
+            file_number += 1
+
+        # start a new folder once one of the counters runs out
+        if (file_number + number_of_files > MAX_FILE_NUMBER or
+                (kind == BURST and group_number >= MAX_GROUP_NUMBER)):
+            folder_number += 1
+            file_number = 0
+            group_number = 0
+
+        folder = '{0:03d}GOPRO'.format(folder_number)
+        ext_name = rng.choice(('MP4', 'JPG'))
+
+        if kind == CHAPTERED:
+            file_number += 1
+            key = '{0:04d}'.format(file_number)
+            media_names = ['GOPR{0}.MP4'.format(key)]
+            media_names.extend('GP{0:02d}{1}.MP4'.format(jj, key)
+                               for jj in range(1, number_of_files))
+
+            # the first file or a chapter was deleted, at least one chapter
+            # GP<xx> has to remain to keep it a chaptered video
+            if len(media_names) > 2 and rng.random() < missing_chapter_prob:
+                del media_names[rng.randrange(len(media_names))]
+
+        elif kind == BURST:
+            group_number += 1
+            key = '{0:03d}'.format(group_number)
+            media_names = []
+            for jj in range(number_of_files):
+                file_number += 1
+                media_names.append('G{0}{1:04d}.{2}'.format(key, file_number, ext_name))
+
+        elif kind == RECORD_3D:
+            file_number += 1
+            key = '{0:04d}'.format(file_number)
+            media_names = ['3D_L{0}.{1}'.format(key, ext_name),
+                           '3D_R{0}.{1}'.format(key, ext_name)]
+
+        else:
+            file_number += 1
+            key = 'GOPR{0:04d}.{1}'.format(file_number, ext_name)
+            media_names = [key]
+
+        sidecar_names = []
+        for name in media_names:
+            if name.endswith('MP4') and rng.random() < sidecar_prob:
+                sidecar_names.extend('{0}.{1}'.format(name[:-4], ext)
+                                     for ext in SIDECAR_EXTENSIONS)
+
+        yield folder, kind, key, media_names, sidecar_names
+
+
+def iter_rnd_card_names(number_of_groups, seed=None, **layout):
+    """ Generate lazily (folder, filename) pairs of realistic card layouts.
+
+    The keyword arguments are the same as for iter_rnd_card_groups.
+    """
+
+    for folder, kind, key, media_names, sidecar_names in iter_rnd_card_groups(
+            number_of_groups, seed=seed, **layout):
+        for name in media_names:
+            yield folder, name
+        for name in sidecar_names:
+            yield folder, name
+
+
+def _check_folder_classification(folder, filelist, expected):
+    """ Compare the result of the find_* methods with the expected groups.
+
+    Returns
+    -------
+    list
+        entries (folder, category) for each category which does not match
+    """
+
+    filelist, chap_vid_group_dict = find_chaptered_videos(filelist, {})
+    filelist, burst_time_lapsed_dict = find_burst_items(filelist, {})
+    filelist, record_3d_dict = find_3d_records(filelist, {})
+    filelist, single_element_list = find_single_items(filelist, [])
+
+    found = {CHAPTERED: chap_vid_group_dict,
+             BURST: burst_time_lapsed_dict,
+             RECORD_3D: record_3d_dict,
+             SINGLE: single_element_list,
+             'remaining': filelist}
+
+    return [(folder, category) for category in found
+            if found[category] != expected[category]]
+
+
+def check_rnd_card_classification(number_of_groups, seed=None, **layout):
+    """ Oracle which checks the classification against generated layouts.
+
+    The names are generated with iter_rnd_card_groups and classified folder
+    by folder, so that only a single folder is kept in memory at a time.
+    The sidecar files are expected to remain unclassified.
+
+    Returns
+    -------
+    (int, list)
+        the number of checked names and a list of (folder, category) entries
+        for each mismatch, an empty list means that everything matched.
+    """
+
+    number_of_names = 0
+    mismatch_list = []
+
+    current_folder = None
+    filelist = []
+    expected = None
+
+    for folder, kind, key, media_names, sidecar_names in iter_rnd_card_groups(
+            number_of_groups, seed=seed, **layout):
+
+        if folder != current_folder:
+            if current_folder is not None:
+                mismatch_list.extend(_check_folder_classification(
+                    current_folder, filelist, expected))
+
+            current_folder = folder
+            filelist = []
+            expected = {CHAPTERED: {}, BURST: {}, RECORD_3D: {}, SINGLE: [],
+                        'remaining': []}
+
+        if kind == SINGLE:
+            expected[SINGLE].extend(media_names)
+        else:
+            expected[kind][key] = list(media_names)
+        expected['remaining'].extend(sidecar_names)
+
+        filelist.extend(media_names)
+        filelist.extend(sidecar_names)
+        number_of_names += len(media_names) + len(sidecar_names)
+
+    if current_folder is not None:
+        mismatch_list.extend(_check_folder_classification(
+            current_folder, filelist, expected))
+
+    return number_of_names, mismatch_list
+
+# Seeded, lazy generation of realistic card layouts
+# =============================================================================
+
 
 def create_sorted_lists(filelist):
     """ Main logic to sort a given filelist into
@@ -448,7 +709,7 @@ def create_sorted_lists(filelist):
     return chap_vid_group_dict, burst_time_lapsed_dict, record_3d_dict, single_element_list, filelist
 
 
-def search_and_rename(filelist):
+def search_and_rename(filelist, directory='.', date_getter=None):
     
     
     chap_vid_group_dict = {}
@@ -462,25 +723,29 @@ def search_and_rename(filelist):
     # ================================
 
     filelist, chap_vid_group_dict = find_chaptered_videos(filelist, chap_vid_group_dict)
-    rename_pattern_list = map_chaptered_videos(chap_vid_group_dict, rename_pattern_list)
+    rename_pattern_list = map_chaptered_videos(chap_vid_group_dict, rename_pattern_list,
+                                               directory, date_getter)
 
     # extract now the burst/time-lapse/looping items:
     # ===============================================
 
     filelist, burst_time_lapsed_dict = find_burst_items(filelist, burst_time_lapsed_dict)
-    rename_pattern_list = map_burst_items(burst_time_lapsed_dict, rename_pattern_list)
+    rename_pattern_list = map_burst_items(burst_time_lapsed_dict, rename_pattern_list,
+                                          directory, date_getter)
     
     # extract now the 3D recordings:
     # ==============================
 
     filelist, record_3d_dict = find_3d_records(filelist, record_3d_dict)
-    rename_pattern_list = map_3d_records(record_3d_dict, rename_pattern_list)
+    rename_pattern_list = map_3d_records(record_3d_dict, rename_pattern_list,
+                                         directory, date_getter)
     
     # finally, extract the single video/photos:
     #==========================================
 
     filelist, single_element_list = find_single_items(filelist, single_element_list)
-    rename_pattern_list = map_single_items(single_element_list, rename_pattern_list)
+    rename_pattern_list = map_single_items(single_element_list, rename_pattern_list,
+                                           directory, date_getter)
      
     # return also the list of the remaining, unextracted files
     
@@ -495,7 +760,7 @@ def find_chaptered_videos(filelist, chap_vid_group_dict={}):
     # need to reverse the iteration prozess to remove entries while stepping
     for entry in reversed(filelist):
         # check for chaptered video
-        match = re.match('GP(\d{2})(\d{4})(\..*)', entry)
+        match = CHAPTER_PATTERN.match(entry)
         if match:
 
             file_number = match.group(2)
@@ -525,7 +790,7 @@ def find_burst_items(filelist, burst_time_lapsed_dict={}):
     # need to reverse the iteration prozess to remove entries while stepping
     for entry in reversed(filelist):
 
-        match = re.match('G(\d{3})(\d{4})(\..*)', entry)
+        match = BURST_PATTERN.match(entry)
         
         if match:
             group_number = match.group(1)
@@ -550,7 +815,7 @@ def find_3d_records(filelist, record_3d_dict={}):
     
     # need to reverse the iteration prozess to remove entries while stepping
     for entry in reversed(filelist):
-        match = re.match('3D_(R|L)(\d{4})(\..*)', entry)
+        match = RECORD_3D_PATTERN.match(entry)
         if match:
             
             file_number = match.group(2)
@@ -572,7 +837,7 @@ def find_3d_records(filelist, record_3d_dict={}):
 def find_single_items(filelist, single_element_list=[]):
     
     for entry in reversed(filelist):
-        match = re.match('GOPR(\d{4})(\..*)', entry)
+        match = SINGLE_PATTERN.match(entry)
         if match:
             single_element_list.insert(0, entry)
             
@@ -587,7 +852,8 @@ def find_single_items(filelist, single_element_list=[]):
 # =============================================================================
 # Indiviuduell mapping algorithms
 
-def map_chaptered_videos(chap_vid_group_dict, chap_vid_map_list=[]):
+def map_chaptered_videos(chap_vid_group_dict, chap_vid_map_list=[], directory='.',
+                         date_getter=None):
     """
         1. The Chaptered Video becomes
 
@@ -597,17 +863,20 @@ def map_chaptered_videos(chap_vid_group_dict, chap_vid_map_list=[]):
 
         GOPR<zzzz>.<ext> ===> <YYYY>-<MM>-<DD>_<hh>H-<mm>m-<ss>s_00_<zzzz>.<ext>
     """
+
+    if date_getter is None:
+        date_getter = get_date_taken
     
     
     for entry in chap_vid_group_dict:
         
         for chap_name in chap_vid_group_dict[entry]:
             
-            match = re.match('GP(\d{2})(\d{4})(\..*)', chap_name)
-            match_start_file = re.match('GOPR(\d{4})(\..*)', chap_name)
+            match = CHAPTER_PATTERN.match(chap_name)
+            match_start_file = SINGLE_PATTERN.match(chap_name)
             
             if match:
-                date_string = '{0}_{1}_{2}{3}'.format(get_date_taken(chap_name), 
+                date_string = '{0}_{1}_{2}{3}'.format(date_getter(os.path.join(directory, chap_name)), 
                                                       match.group(1),
                                                       match.group(2),
                                                       match.group(3))
@@ -616,9 +885,9 @@ def map_chaptered_videos(chap_vid_group_dict, chap_vid_map_list=[]):
                 
             elif match_start_file:
                 
-                date_string = '{0}_00_{1}{2}'.format(get_date_taken(chap_name), 
-                                                      match.group(1),
-                                                      match.group(2))
+                date_string = '{0}_00_{1}{2}'.format(date_getter(os.path.join(directory, chap_name)), 
+                                                      match_start_file.group(1),
+                                                      match_start_file.group(2))
                 # make a file list map to what the file should be renamed
                 chap_vid_map_list.append([chap_name, date_string])                
                 
@@ -631,22 +900,26 @@ def map_chaptered_videos(chap_vid_group_dict, chap_vid_map_list=[]):
     return chap_vid_map_list
 
 
-def map_burst_items(burst_time_lapsed_dict, burst_map_list=[]):
+def map_burst_items(burst_time_lapsed_dict, burst_map_list=[], directory='.',
+                    date_getter=None):
     """
     2. Burst, time-lapsed pictures or looping videos become
 
         G<yyy><zzzz>.<ext>  ===> <YYYY>-<MM>-<DD>_<hh>H-<mm>m-<ss>s_<yyy>_<zzzz>.<ext>
 
     """
+
+    if date_getter is None:
+        date_getter = get_date_taken
     
     
     for entry in burst_time_lapsed_dict:
         
         for burst_name in burst_time_lapsed_dict[entry]:
             
-            match = re.match('G(\d{3})(\d{4})(\..*)', burst_name)
+            match = BURST_PATTERN.match(burst_name)
             
-            date_string = '{0}_{1}_{2}{3}'.format(get_date_taken(burst_name), 
+            date_string = '{0}_{1}_{2}{3}'.format(date_getter(os.path.join(directory, burst_name)), 
                                                   match.group(1),
                                                   match.group(2),
                                                   match.group(3))
@@ -657,20 +930,24 @@ def map_burst_items(burst_time_lapsed_dict, burst_map_list=[]):
     return burst_map_list
 
 
-def map_3d_records(record_3d_dict, record_3d_map_list=[]):
+def map_3d_records(record_3d_dict, record_3d_map_list=[], directory='.',
+                   date_getter=None):
     """
         3. 3d videos or photos become
     
         3D_<D><zzzz>.<ext> ===> <YYYY>-<MM>-<DD>_<hh>H-<mm>m-<ss>s_<zzzz>_<D>.<ext>
     """
+
+    if date_getter is None:
+        date_getter = get_date_taken
     
     for entry in record_3d_dict:
         
         for name_3d in record_3d_dict[entry]:
             
-            match = re.match('3D_(R|L)(\d{4})(\..*)', name_3d)
+            match = RECORD_3D_PATTERN.match(name_3d)
             
-            date_string = '{0}_{1}_{2}{3}'.format(get_date_taken(name_3d), 
+            date_string = '{0}_{1}_{2}{3}'.format(date_getter(os.path.join(directory, name_3d)), 
                                                   match.group(2),
                                                   match.group(1),
                                                   match.group(3))
@@ -680,17 +957,21 @@ def map_3d_records(record_3d_dict, record_3d_map_list=[]):
     return record_3d_map_list
 
 
-def map_single_items(single_item_list, single_item_map_list=[]):
+def map_single_items(single_item_list, single_item_map_list=[], directory='.',
+                     date_getter=None):
     """ 
         4. single photos and videos become
     
         GOPR<zzzz>.<ext> ===> <YYYY>-<MM>-<DD>_<hh>H-<mm>m-<ss>s_<zzzz>.<ext>
     
     """
+
+    if date_getter is None:
+        date_getter = get_date_taken
     
     for entry in single_item_list:
-        match = re.match('GOPR(\d{4})(\..*)', entry)
-        date_string = '{0}_{1}{2}'.format(get_date_taken(entry), 
+        match = SINGLE_PATTERN.match(entry)
+        date_string = '{0}_{1}{2}'.format(date_getter(os.path.join(directory, entry)), 
                                               match.group(1),
                                               match.group(2))
         
@@ -717,14 +998,19 @@ def copy_with_meta(old_filename, new_filename):
     return shutil.copy2(old_filename, new_filename) 
 
 def rename_filename(pattern_map_list):
-    """ A rename method. """
+    """ A rename method, returns False if the file could not be renamed. """
     try:
-        os.rename(pattern_map_list[0], pattern_map_list[1])
+        with metrics.timer('gopro_rename_seconds'):
+            os.rename(pattern_map_list[0], pattern_map_list[1])
+        metrics.inc('gopro_files_renamed_total')
+        return True
     except Exception as exp:
+        metrics.inc('gopro_rename_errors_total')
         print('Cannot rename file "{0}" ==> "{1}". The following error '
               'occured: {2}'.format(pattern_map_list[0],
                                     pattern_map_list[1],
                                     exp))
+        return False
 
 def get_date_taken(path):
     
@@ -743,7 +1029,9 @@ def get_date_taken(path):
 
 def get_creation_date_img(path):
     
-    creation_date = Image.open(path)._getexif()[36867]
+    with metrics.timer('gopro_probe_seconds', backend='exif'):
+        creation_date = Image.open(path)._getexif()[36867]
+    metrics.inc('gopro_files_probed_total', backend='exif')
     
     creation_date_dt = datetime.datetime.strptime(creation_date, '%Y:%m:%d %H:%M:%S')
     
@@ -757,9 +1045,11 @@ def get_creation_date_vid(path):
     
     command = ['ffprobe', path, '-v', 'quiet', '-print_format', 'json',
                '-show_streams']
-    ffmpeg = subprocess.Popen(command, stderr=subprocess.PIPE, 
-                              stdout=subprocess.PIPE)
-    out, err = ffmpeg.communicate()
+    with metrics.timer('gopro_probe_seconds', backend='ffprobe'):
+        ffmpeg = subprocess.Popen(command, stderr=subprocess.PIPE, 
+                                  stdout=subprocess.PIPE)
+        out, err = ffmpeg.communicate()
+    metrics.inc('gopro_files_probed_total', backend='ffprobe')
     
     meta_dict = json.loads(out.decode())
     
@@ -808,24 +1098,2195 @@ def extract_from_files(test_file_list):
     print(remaining_list)
 
 
-if __name__ == '__main__':
+# =============================================================================
+# Metrics of a running job
 
-#    extract_from_files(test_file_list)
-    
-#    print(gen_rnd_file_list())
-#    print(gen_rnd_chap_list(number_of_files=10))
-#    print(gen_rnd_burst_loop_list())
-    
-    folderpath = os.path.abspath(r'C:\Users\AlexS\Desktop\test2')
-    os.chdir(folderpath)
-    print(os.path.abspath(os.curdir))
-    filelist = get_all_files_in_folder(folderpath)
-    print(filelist)
-    
-    rename_pattern_list = search_and_rename(filelist)
-    
-    for rename_pattern in rename_pattern_list:
-        rename_filename(rename_pattern)
+# upper bounds in seconds of the latency histogram buckets
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                           5.0, 10.0)
+
+
+class Histogram:
+    """ A latency histogram with fixed buckets in the style of Prometheus. """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last entry counts the values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer:
+    """ Context manager which observes its runtime in a histogram. """
+
+    def __init__(self, registry, name, labels):
+        self._registry = registry
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._registry.observe(self._name, time.perf_counter() - self._start,
+                               **self._labels)
+        return False
+
+
+def _metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_metric_name(name, labels, extra_labels=()):
+
+    label_list = list(labels) + list(extra_labels)
+    if not label_list:
+        return name
+
+    label_string = ','.join('{0}="{1}"'.format(key, value) for key, value in label_list)
+    return '{0}{{{1}}}'.format(name, label_string)
+
+
+class MetricsRegistry:
+    """ Collect counters and latency histograms of a running job.
+
+    The metric names follow the Prometheus conventions: counters end with
+    '_total' and latencies are measured in seconds. Labels are passed as
+    keyword arguments, e.g.
+
+        metrics.inc('gopro_files_renamed_total')
+        with metrics.timer('gopro_probe_seconds', backend='ffprobe'):
+            ...
+    """
+
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.start_time = time.time()
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        """ Increase a counter by value. """
+
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ Add a value to a histogram. """
+
+        key = _metric_key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """ Return a context manager which observes its runtime in name. """
+        return _Timer(self, name, labels)
+
+    def snapshot(self):
+        """ Return the current state of all metrics as a json compatible dict.
+
+        Besides the raw values, the rate per second since the start of the
+        registry is given for every counter, e.g. the files per second.
+        """
+
+        with self._lock:
+            elapsed = max(time.time() - self.start_time, 1e-9)
+
+            counters = []
+            for (name, labels), value in sorted(self._counters.items()):
+                counters.append({'name': name,
+                                 'labels': dict(labels),
+                                 'value': value,
+                                 'rate': value / elapsed})
+
+            histograms = []
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                histograms.append({'name': name,
+                                   'labels': dict(labels),
+                                   'buckets': list(histogram.buckets),
+                                   'counts': list(histogram.counts),
+                                   'sum': histogram.sum,
+                                   'count': histogram.count})
+
+        return {'timestamp': time.time(),
+                'uptime_seconds': elapsed,
+                'counters': counters,
+                'histograms': histograms}
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self):
+        """ Return all metrics in the Prometheus text exposition format. """
+
+        snapshot = self.snapshot()
+        lines = ['# TYPE gopro_uptime_seconds gauge',
+                 'gopro_uptime_seconds {0}'.format(snapshot['uptime_seconds'])]
+
+        declared = set()
+        for counter in snapshot['counters']:
+            if counter['name'] not in declared:
+                declared.add(counter['name'])
+                lines.append('# TYPE {0} counter'.format(counter['name']))
+            lines.append('{0} {1}'.format(
+                _format_metric_name(counter['name'], counter['labels'].items()),
+                counter['value']))
+
+        for hist in snapshot['histograms']:
+            name = hist['name']
+            labels = hist['labels'].items()
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE {0} histogram'.format(name))
+
+            cumulative = 0
+            bounds = [str(bound) for bound in hist['buckets']] + ['+Inf']
+            for bound, count in zip(bounds, hist['counts']):
+                cumulative += count
+                lines.append('{0} {1}'.format(
+                    _format_metric_name(name + '_bucket', labels, [('le', bound)]),
+                    cumulative))
+            lines.append('{0} {1}'.format(_format_metric_name(name + '_sum', labels),
+                                          hist['sum']))
+            lines.append('{0} {1}'.format(_format_metric_name(name + '_count', labels),
+                                          hist['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, file_format='prometheus'):
+        """ Write the metrics atomically to path.
+
+        A textfile collector or another reader will therefore never see a
+        half written file.
+        """
+
+        if file_format == 'prometheus':
+            content = self.to_prometheus()
+        elif file_format == 'json':
+            content = self.to_json()
+        else:
+            raise Exception('Unknown metrics format "{0}" was given!'.format(file_format))
+
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(content)
+        os.replace(tmp_path, path)
+
+
+class _NullMetrics:
+    """ Drop-in for MetricsRegistry which does nothing if metrics are off. """
+
+    enabled = False
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return _NULL_TIMER
+
+
+_NULL_TIMER = contextlib.nullcontext()
+
+# the active registry, disabled by default
+metrics = _NullMetrics()
+
+
+def enable_metrics(buckets=DEFAULT_LATENCY_BUCKETS):
+    """ Start to collect metrics and return the registry. """
+    global metrics
+    metrics = MetricsRegistry(buckets)
+    return metrics
+
+
+def disable_metrics():
+    """ Stop to collect metrics. """
+    global metrics
+    metrics = _NullMetrics()
+
+
+class MetricsExporter:
+    """ Write periodic snapshots of the metrics to a file.
+
+    Use a path in the directory of the node exporter textfile collector for
+    the 'prometheus' format, or any path for the 'json' format. A last
+    snapshot is written when the exporter is stopped.
+    """
+
+    def __init__(self, path, interval=5.0, file_format='prometheus'):
+        self.path = path
+        self.interval = interval
+        self.file_format = file_format
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._write()
+
+    def _write(self):
+        if metrics.enabled:
+            metrics.write(self.path, self.file_format)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._write()
+
+# Metrics of a running job
+# =============================================================================
+
+
+# =============================================================================
+# Physical read scheduling
+
+# ioctl to get the extent map of a file on Linux, _IOWR('f', 11, struct fiemap)
+FS_IOC_FIEMAP = 0xC020660B
+# the extent has no position yet, e.g. since it is not yet written to disk
+FIEMAP_EXTENT_UNKNOWN = 0x2
+
+# struct fiemap without the extents and a single struct fiemap_extent
+_FIEMAP_HEADER = struct.Struct('=QQLLLL')
+_FIEMAP_EXTENT = struct.Struct('=QQQ2QL3L')
+
+# bytes of the start and of the end of a file which are needed by a probe,
+# the 'moov' atom of a MP4 file is often placed at its end
+READAHEAD_HEADER_BYTES = 64 * 1024
+READAHEAD_TAIL_BYTES = 1024 * 1024
+
+
+def _get_physical_offset_fd(fd):
+    """ Return the physical offset of the first extent of an open file. """
+
+    if fcntl is None:
+        return None
+
+    request = bytearray(_FIEMAP_HEADER.size + _FIEMAP_EXTENT.size)
+    # map from the start over the whole file, but only the first extent
+    _FIEMAP_HEADER.pack_into(request, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+
+    mapped_extents = _FIEMAP_HEADER.unpack_from(request, 0)[3]
+    if mapped_extents == 0:
+        return None
+
+    extent = _FIEMAP_EXTENT.unpack_from(request, _FIEMAP_HEADER.size)
+    if extent[5] & FIEMAP_EXTENT_UNKNOWN:
+        return None
+
+    return extent[1]
+
+
+def _advise_readahead_fd(fd, size, header_bytes=READAHEAD_HEADER_BYTES,
+                         tail_bytes=READAHEAD_TAIL_BYTES):
+    """ Announce the reads of the header and of the tail of an open file. """
+
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    try:
+        os.posix_fadvise(fd, 0, min(header_bytes, size), os.POSIX_FADV_WILLNEED)
+        if size > header_bytes:
+            tail_start = max(header_bytes, size - tail_bytes)
+            os.posix_fadvise(fd, tail_start, size - tail_start, os.POSIX_FADV_WILLNEED)
+        metrics.inc('gopro_readahead_hints_total')
+    except OSError:
+        pass
+
+
+def get_physical_offset(path):
+    """ Return the physical position of the first block of a file.
+
+    Returns
+    -------
+    int
+        the physical byte offset of the first extent or None, if the extent
+        map cannot be retrieved (e.g. no Linux, no FIEMAP support of the file
+        system, an empty file or a file which is not yet written to disk).
+    """
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        return _get_physical_offset_fd(fd)
+    finally:
+        os.close(fd)
+
+
+def get_physical_order_key(path):
+    """ Return a sort key which follows the layout of the file on the disk.
+
+    The physical offset is used where FIEMAP is available, otherwise the
+    inode number, which is on most file systems allocated in the order of
+    the creation of the files. Both are read from a single open of the file.
+    """
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return (2, 0)
+
+    try:
+        offset = _get_physical_offset_fd(fd)
+        if offset is not None:
+            return (0, offset)
+
+        return (1, os.fstat(fd).st_ino)
+    finally:
+        os.close(fd)
+
+
+def order_by_physical_layout(item_list, get_paths=None, workers=1):
+    """ Sort items so that they are read with a minimum of seeking.
+
+    Parameters
+    ----------
+    item_list : list
+        the items to sort, by default the paths of the files
+    get_paths : function
+        returns the paths of an item, if the items are not the paths. An
+        item is placed at the position of its first file on the disk.
+    workers : int
+        number of threads which retrieve the positions, so that the latency
+        of a slow reader is not paid once per file
+
+    Returns
+    -------
+    list
+        a new list with the items sorted by their physical layout
+    """
+
+    if get_paths is None:
+        get_paths = lambda item: [item]
+
+    def item_key(item):
+        return min(get_physical_order_key(path) for path in get_paths(item))
+
+    with metrics.timer('gopro_physical_order_seconds'):
+        if workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                key_list = list(executor.map(item_key, item_list))
+        else:
+            key_list = [item_key(item) for item in item_list]
+
+    order = sorted(range(len(item_list)), key=key_list.__getitem__)
+    return [item_list[index] for index in order]
+
+
+def advise_readahead(path_list, header_bytes=READAHEAD_HEADER_BYTES,
+                     tail_bytes=READAHEAD_TAIL_BYTES):
+    """ Tell the kernel that the headers and tails of the files are needed soon.
+
+    All hints of a batch are issued together, so that the reads of files
+    which are close to each other on the disk are queued at the same time
+    and can be merged by the I/O scheduler. The call returns immediately,
+    the reading happens in the background.
+    """
+
+    for path in path_list:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+
+        try:
+            _advise_readahead_fd(fd, os.fstat(fd).st_size, header_bytes, tail_bytes)
+        finally:
+            os.close(fd)
+
+
+def write_synthetic_card(directory, number_of_groups=500, seed=0, file_size=4 * 1024 * 1024,
+                         **layout):
+    """ Write files with the names of a generated card, but random content.
+
+    The files are written in a shuffled order, so that the order on the disk
+    differs from the order of the names like on a card which was written by
+    several copy jobs. Only the names of the first folder of the layout are
+    used.
+
+    Returns
+    -------
+    list
+        the names of the written files
+    """
+
+    rng = random.Random(seed)
+    names = []
+    for folder, name in iter_rnd_card_names(number_of_groups, seed=seed, **layout):
+        if names and folder != '100GOPRO':
+            break
+        names.append(name)
+
+    write_order = list(names)
+    rng.shuffle(write_order)
+
+    block = os.urandom(min(file_size, 1024 * 1024))
+    for name in write_order:
+        with open(os.path.join(directory, name), 'wb') as file_obj:
+            remaining = file_size
+            while remaining > 0:
+                file_obj.write(block[:remaining])
+                remaining -= len(block)
+
+    # allocate the blocks, so that FIEMAP reports their position
+    os.sync()
+
+    return names
+
+
+def _drop_file_cache(path):
+    """ Remove the clean pages of a file from the page cache. """
+
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _read_header_and_tail(path, header_bytes=READAHEAD_HEADER_BYTES,
+                          tail_bytes=READAHEAD_TAIL_BYTES):
+    """ Read the parts of a file which a probe reads, e.g. ffprobe on a MP4. """
+
+    with open(path, 'rb') as file_obj:
+        size = os.fstat(file_obj.fileno()).st_size
+        file_obj.read(header_bytes)
+        file_obj.seek(max(header_bytes, size - tail_bytes))
+        file_obj.read(tail_bytes)
+
+
+def benchmark_physical_order(directory, repeat=3, advise_ahead=64):
+    """ Measure the probe reads in listing order against physical order.
+
+    Each run drops the files from the page cache and then reads the header
+    and the tail of every file, like ffprobe does for a MP4 file with the
+    'moov' atom at its end. Use write_synthetic_card to fill the directory.
+    With advise, the hints are issued advise_ahead files before the reads,
+    like the bounded queue of RenamePipeline does.
+    The result depends on the device: on hard disks and SD readers the
+    physical order should win, on SSDs both orders are about the same.
+
+    Returns
+    -------
+    dict
+        the best runtime in seconds of each order
+    """
+
+    names = [name for name in os.listdir(directory)
+             if os.path.isfile(os.path.join(directory, name))]
+    listing_paths = [os.path.join(directory, name) for name in names]
+
+    result = {'files': len(names), 'listing_seconds': None, 'physical_seconds': None,
+              'physical_with_advise_seconds': None}
+
+    for attempt in range(repeat):
+        for order_name in ('listing_seconds', 'physical_seconds',
+                           'physical_with_advise_seconds'):
+            for path in listing_paths:
+                _drop_file_cache(path)
+
+            start = time.perf_counter()
+            if order_name == 'listing_seconds':
+                path_list = listing_paths
+            else:
+                path_list = order_by_physical_layout(listing_paths)
+
+            advise = order_name == 'physical_with_advise_seconds'
+            if advise:
+                advise_readahead(path_list[:advise_ahead])
+            for index, path in enumerate(path_list):
+                if advise and index + advise_ahead < len(path_list):
+                    advise_readahead([path_list[index + advise_ahead]])
+                _read_header_and_tail(path)
+            seconds = time.perf_counter() - start
+
+            if result[order_name] is None or seconds < result[order_name]:
+                result[order_name] = seconds
+
+    return result
+
+# Physical read scheduling
+# =============================================================================
+
+# =============================================================================
+# GPS time from the GPMF telemetry
+
+"""
+GoPro stores its telemetry (GPMF) in a separate 'meta' track of the MP4 file
+with the sample format 'gpmd'. Each sample is a tree of KLV entries:
+
+    key (4 bytes) | type (1 byte) | size (1 byte) | repeat (2 bytes) | data
+
+where data has size * repeat bytes and is padded to 4 bytes. The type 0
+marks a nested entry (e.g. DEVC and STRM). The GPS stream carries the UTC
+time as 'GPSU' with the format 'yymmddhhmmss.sss' and the fix as 'GPSF'.
+
+Only the box headers, the first entries of the sample tables and the first
+samples of the track are read, the media data itself is never touched.
+"""
+
+# the times in MP4 files count the seconds since this date
+MP4_EPOCH = datetime.datetime(1904, 1, 1)
+
+GPMF_MAX_SAMPLES = 3
+
+# the time zones differ from UTC by multiples of 15 minutes
+TIMEZONE_STEP = datetime.timedelta(minutes=15)
+
+_BOX_HEADER = struct.Struct('>I4s')
+_KLV_HEADER = struct.Struct('>4scBH')
+
+
+def _read_at(file_obj, offset, size):
+    """ Read size bytes at offset and count them as read by the gpmf backend. """
+
+    file_obj.seek(offset)
+    data = file_obj.read(size)
+    metrics.inc('gopro_bytes_read_total', len(data), backend='gpmf')
+    return data
+
+
+def _iter_boxes(file_obj, start, end):
+    """ Iterate over the MP4 boxes between start and end.
+
+    Returns
+    -------
+    generator
+        yielding (box_type, payload_start, box_end)
+    """
+
+    position = start
+    while position + _BOX_HEADER.size <= end:
+        header = _read_at(file_obj, position, 16)
+        if len(header) < _BOX_HEADER.size:
+            return
+
+        size, box_type = _BOX_HEADER.unpack_from(header)
+        payload_start = position + 8
+
+        if size == 1:
+            if len(header) < 16:
+                return
+            # the real size follows as 64 bit value
+            size = struct.unpack_from('>Q', header, 8)[0]
+            payload_start += 8
+        elif size == 0:
+            # the box extends to the end
+            size = end - position
+
+        if size < payload_start - position:
+            return
+
+        yield box_type, payload_start, position + size
+        position += size
+
+
+def _find_box(file_obj, start, end, box_path):
+    """ Return (payload_start, box_end) of the box with the box_path or None. """
+
+    for box_type, payload_start, box_end in _iter_boxes(file_obj, start, end):
+        if box_type == box_path[0]:
+            if len(box_path) == 1:
+                return payload_start, box_end
+            return _find_box(file_obj, payload_start, box_end, box_path[1:])
+
+    return None
+
+
+def _read_table(file_obj, box, entry_format, max_entries):
+    """ Read the first entries of a sample table with a version/flags field. """
+
+    if box is None:
+        return []
+
+    payload_start, box_end = box
+    entry_count = struct.unpack('>I', _read_at(file_obj, payload_start + 4, 4))[0]
+    entry_struct = struct.Struct(entry_format)
+    entry_count = min(entry_count, max_entries)
+
+    data = _read_at(file_obj, payload_start + 8, entry_count * entry_struct.size)
+    return [entry_struct.unpack_from(data, ii * entry_struct.size)
+            for ii in range(len(data) // entry_struct.size)]
+
+
+def _read_camera_time(file_obj, moov):
+    """ Return the creation time of the camera clock from the 'mvhd' box. """
+
+    mvhd = _find_box(file_obj, moov[0], moov[1], [b'mvhd'])
+    if mvhd is None:
+        return None
+
+    data = _read_at(file_obj, mvhd[0], 12)
+    if data[0] == 1:
+        seconds = struct.unpack_from('>Q', data, 4)[0]
+    else:
+        seconds = struct.unpack_from('>I', data, 4)[0]
+
+    return MP4_EPOCH + datetime.timedelta(seconds=seconds)
+
+
+def _find_gpmf_samples(file_obj, moov, max_samples):
+    """ Locate the first samples of the 'gpmd' track.
+
+    Returns
+    -------
+    list
+        tuples (offset, size, start_time) of the first samples, where
+        start_time is the time in seconds since the start of the recording
+    """
+
+    for box_type, payload_start, box_end in _iter_boxes(file_obj, moov[0], moov[1]):
+        if box_type != b'trak':
+            continue
+
+        mdia = _find_box(file_obj, payload_start, box_end, [b'mdia'])
+        if mdia is None:
+            continue
+
+        hdlr = _find_box(file_obj, mdia[0], mdia[1], [b'hdlr'])
+        if hdlr is None or _read_at(file_obj, hdlr[0] + 8, 4) != b'meta':
+            continue
+
+        stbl = _find_box(file_obj, mdia[0], mdia[1], [b'minf', b'stbl'])
+        if stbl is None:
+            continue
+
+        stsd = _find_box(file_obj, stbl[0], stbl[1], [b'stsd'])
+        # the format of the first sample description
+        if stsd is None or _read_at(file_obj, stsd[0] + 12, 4) != b'gpmd':
+            continue
+
+        mdhd = _find_box(file_obj, mdia[0], mdia[1], [b'mdhd'])
+        stsz = _find_box(file_obj, stbl[0], stbl[1], [b'stsz'])
+        if mdhd is None or stsz is None:
+            continue
+
+        version = _read_at(file_obj, mdhd[0], 1)
+        timescale_offset = 20 if version == b'\x01' else 12
+        timescale = struct.unpack('>I', _read_at(file_obj, mdhd[0] + timescale_offset, 4))[0]
+
+        def table(box_type, entry_format):
+            box = _find_box(file_obj, stbl[0], stbl[1], [box_type])
+            return _read_table(file_obj, box, entry_format, max_samples)
+
+        chunk_offsets = [entry[0] for entry in table(b'stco', '>I')]
+        if not chunk_offsets:
+            chunk_offsets = [entry[0] for entry in table(b'co64', '>Q')]
+
+        # the sample size is either fixed or given per sample
+        fixed_size = struct.unpack('>I', _read_at(file_obj, stsz[0] + 4, 4))[0]
+        if fixed_size:
+            sample_sizes = [fixed_size] * max_samples
+        else:
+            payload_start, box_end = stsz
+            sample_count = struct.unpack('>I', _read_at(file_obj, payload_start + 8, 4))[0]
+            data = _read_at(file_obj, payload_start + 12, min(sample_count, max_samples) * 4)
+            sample_sizes = list(struct.unpack('>{0}I'.format(len(data) // 4), data))
+
+        sample_to_chunk = table(b'stsc', '>III')
+        time_to_sample = table(b'stts', '>II')
+
+        return _map_samples(chunk_offsets, sample_sizes, sample_to_chunk,
+                            time_to_sample, timescale, max_samples)
+
+    return []
+
+
+def _map_samples(chunk_offsets, sample_sizes, sample_to_chunk, time_to_sample,
+                 timescale, max_samples):
+    """ Calculate offset and start time of the first samples from the tables. """
+
+    sample_list = []
+    sample_index = 0
+
+    for chunk_index, chunk_offset in enumerate(chunk_offsets):
+
+        # the last entry of 'stsc' with a first chunk (counting from 1) up
+        # to the current chunk is valid
+        samples_per_chunk = 1
+        for first_chunk, samples, description in sample_to_chunk:
+            if first_chunk <= chunk_index + 1:
+                samples_per_chunk = samples
+
+        offset = chunk_offset
+        for ii in range(samples_per_chunk):
+            if sample_index >= min(max_samples, len(sample_sizes)):
+                return sample_list
+
+            sample_list.append((offset, sample_sizes[sample_index],
+                                _sample_start_time(time_to_sample, sample_index, timescale)))
+            offset += sample_sizes[sample_index]
+            sample_index += 1
+
+    return sample_list
+
+
+def _sample_start_time(time_to_sample, sample_index, timescale):
+
+    start_time = 0
+    remaining = sample_index
+    for sample_count, sample_delta in time_to_sample:
+        step = min(sample_count, remaining)
+        start_time += step * sample_delta
+        remaining -= step
+        if not remaining:
+            break
+
+    return start_time / float(timescale or 1)
+
+
+def _iter_klv(data, start, end):
+    """ Iterate over the KLV entries of a GPMF payload, also the nested ones.
+
+    Returns
+    -------
+    generator
+        yielding (key, type, payload)
+    """
+
+    position = start
+    while position + _KLV_HEADER.size <= end:
+        key, value_type, size, repeat = _KLV_HEADER.unpack_from(data, position)
+        payload_start = position + _KLV_HEADER.size
+        payload_end = payload_start + size * repeat
+
+        if payload_end > end:
+            return
+
+        if value_type == b'\x00':
+            for entry in _iter_klv(data, payload_start, payload_end):
+                yield entry
+        else:
+            yield key, value_type, data[payload_start:payload_end]
+
+        # the payload is aligned to 32 bit
+        position = payload_start + (size * repeat + 3) // 4 * 4
+
+
+def parse_gpmf_gps_time(data):
+    """ Return the GPS UTC time of a GPMF sample or None without GPS lock.
+
+    Parameters
+    ----------
+    data : bytes
+        the content of a 'gpmd' sample
+    """
+
+    gps_time = None
+    gps_fix = None
+
+    for key, value_type, payload in _iter_klv(data, 0, len(data)):
+        if key == b'GPSU' and value_type == b'U':
+            gps_time = payload[:16].decode('ascii', 'replace')
+        elif key == b'GPSF':
+            gps_fix = struct.unpack('>I', payload[:4])[0]
+
+    # the time is meaningless without a 2D or 3D fix
+    if gps_time is None or (gps_fix is not None and gps_fix < 2):
+        return None
+
+    try:
+        return datetime.datetime.strptime(gps_time, '%y%m%d%H%M%S.%f')
+    except ValueError:
+        return None
+
+
+def _find_moov(file_obj, path):
+
+    file_size = os.fstat(file_obj.fileno()).st_size
+    moov = _find_box(file_obj, 0, file_size, [b'moov'])
+    if moov is None:
+        raise Exception('No "moov" box found in "{0}"!'.format(path))
+
+    return moov
+
+
+def read_mp4_camera_time(path):
+    """ Return the creation time of a video according to the camera clock. """
+
+    with open(path, 'rb') as file_obj:
+        camera_time = _read_camera_time(file_obj, _find_moov(file_obj, path))
+
+    if camera_time is None:
+        raise Exception('No creation time found in "{0}"!'.format(path))
+
+    return camera_time
+
+
+def read_gpmf_clock_offset(path, max_samples=GPMF_MAX_SAMPLES):
+    """ Compare the camera clock of a video with the time of its GPS.
+
+    Returns
+    -------
+    (datetime, timedelta)
+        the creation time of the camera clock and the offset which has to be
+        added to get the GPS UTC time. The offset is None if the video has
+        no GPS lock in its first samples or no GPMF track at all.
+    """
+
+    with metrics.timer('gopro_probe_seconds', backend='gpmf'), open(path, 'rb') as file_obj:
+
+        moov = _find_moov(file_obj, path)
+        camera_time = _read_camera_time(file_obj, moov)
+        if camera_time is None:
+            raise Exception('No creation time found in "{0}"!'.format(path))
+
+        for offset, size, start_time in _find_gpmf_samples(file_obj, moov, max_samples):
+            gps_time = parse_gpmf_gps_time(_read_at(file_obj, offset, size))
+            if gps_time is not None:
+                # the GPS time of the sample refers to its position in the video
+                capture_time = gps_time - datetime.timedelta(seconds=start_time)
+                return camera_time, capture_time - camera_time
+
+    return camera_time, None
+
+
+def find_card_clock_offset(directory):
+    """ Determine the offset between camera clock and GPS time of a folder.
+
+    The GPMF track of the videos in the folder is read in the order of their
+    names until one video has a GPS lock. Only the first samples of each
+    video are read, but a folder without any GPS lock costs a read of every
+    video. Videos which cannot be parsed, e.g. since they are still written,
+    are skipped.
+
+    Returns
+    -------
+    timedelta
+        the offset to add to the camera clock, or None if no video of the
+        folder has a GPS lock
+    """
+
+    video_list = sorted(name for name in os.listdir(directory)
+                        if name[-3:].lower() == 'mp4')
+
+    for name in video_list:
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+
+        try:
+            camera_time, offset = read_gpmf_clock_offset(path)
+        except Exception as exp:
+            print('Cannot read the GPS time of "{0}". The following error '
+                  'occured: {1}'.format(path, exp))
+            continue
+
+        if offset is not None:
+            return offset
+
+    return None
+
+
+def split_clock_offset(offset):
+    """ Split the offset of the camera clock into time zone and drift.
+
+    The camera clock is usually set to local time, so the offset to the GPS
+    UTC time is made of the time zone, a multiple of 15 minutes, and the
+    drift of the clock. A drift of more than 7.5 minutes cannot be told
+    apart from the time zone and is only corrected up to the next multiple
+    of 15 minutes.
+
+    Returns
+    -------
+    (timedelta, timedelta)
+        the time zone of the camera clock and its drift
+    """
+
+    step_seconds = TIMEZONE_STEP.total_seconds()
+    timezone = TIMEZONE_STEP * round(offset.total_seconds() / step_seconds)
+    return timezone, offset - timezone
+
+
+class ClockOffsetCache:
+    """ Keep the offset between camera clock and GPS time per card folder.
+
+    All files of a folder were recorded with the same camera clock, so the
+    offset is determined once per folder with find_card_clock_offset, before
+    the date of the first file of the folder is returned. A cache must only
+    live as long as a single run, since card readers mount every card at the
+    same path and a later card would get the offset of the first one. All files of the
+    folder, the videos and the photos, are then corrected with the same
+    offset. If no video of the folder has a GPS lock, all files of the
+    folder keep the time of the camera clock, so that they never mix
+    corrected and uncorrected times.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._offsets = {}
+
+    def get(self, directory):
+        """ Return the offset of a folder, None if it has no GPS lock. """
+
+        # the lock is held while the offset is determined, so that parallel
+        # probes of the same folder wait for it instead of using the camera
+        # clock in the meantime
+        with self._lock:
+            if directory in self._offsets:
+                metrics.inc('gopro_cache_hits_total', cache='clock_offset')
+                return self._offsets[directory]
+
+            metrics.inc('gopro_cache_misses_total', cache='clock_offset')
+            offset = find_card_clock_offset(directory)
+            self._offsets[directory] = offset
+            return offset
+
+    def set(self, directory, offset):
+        with self._lock:
+            self._offsets[directory] = offset
+
+
+def get_gps_corrected_date(path, offset_cache=None):
+    """ Return the creation date of a file corrected by the GPS time.
+
+    Videos are read from their 'mvhd' box, photos from their EXIF data, and
+    both are corrected with the offset of their folder. Without an
+    offset_cache the offset is determined anew for each file, see
+    ClockOffsetCache. Only the drift of the camera clock is corrected, its
+    time zone is kept, see split_clock_offset. So all the files stay in the
+    time zone of the camera clock, whether their folder has a GPS lock or
+    not, and the files of several cards can be ordered together.
+
+    Returns
+    -------
+    (datetime, timedelta)
+        the corrected creation time and the corrected drift, which is None
+        if the folder has no GPS lock and the time of the camera clock is
+        returned
+    """
+
+    extension = path[-3:].lower()
+
+    if extension == 'mp4':
+        camera_time = read_mp4_camera_time(path)
+    elif extension == 'jpg':
+        camera_time = datetime.datetime.strptime(get_creation_date_img(path),
+                                                 '%Y-%m-%d_%Hh%Mm%Ss')
+    else:
+        raise Exception('What is this for an extension??? "{0}" was given!'.format(extension))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    if offset_cache is None:
+        offset = find_card_clock_offset(directory)
+    else:
+        offset = offset_cache.get(directory)
+    if offset is None:
+        return camera_time, None
+
+    timezone, drift = split_clock_offset(offset)
+    return camera_time + drift, drift
+
+
+def get_date_taken_gps(path, offset_cache=None):
+    """ Drop-in for get_date_taken which corrects the camera clock by GPS.
+
+    RenamePipeline passes its own ClockOffsetCache, so that the offset of a
+    folder is determined once per run.
+    """
+
+    corrected_time, offset = get_gps_corrected_date(path, offset_cache)
+    return corrected_time.strftime('%Y-%m-%d_%Hh%Mm%Ss')
+
+# GPS time from the GPMF telemetry
+# =============================================================================
+
+
+# =============================================================================
+# Preflight check for files in use
+
+def _get_own_pids(proc_path, pid_list):
+    """ Return this process and all its descendants, e.g. running ffprobes. """
+
+    children_dict = {}
+    for pid in pid_list:
+        try:
+            with open(os.path.join(proc_path, pid, 'stat')) as file_obj:
+                stat = file_obj.read()
+        except OSError:
+            continue
+
+        # the command name in brackets may contain spaces and brackets
+        parent_pid = stat[stat.rfind(')') + 2:].split()[1]
+        children_dict.setdefault(parent_pid, []).append(pid)
+
+    own_pids = set()
+    pending_list = [str(os.getpid())]
+    while pending_list:
+        pid = pending_list.pop()
+        own_pids.add(pid)
+        pending_list.extend(children_dict.get(pid, []))
+
+    return own_pids
+
+
+def get_open_file_ids(proc_path='/proc'):
+    """ Collect the files which are held open by other processes.
+
+    A single sweep over the file descriptors in /proc/<pid>/fd replaces a
+    trial open or a call of lsof for each file. Processes of other users
+    can only be seen with sufficient rights. The files of this process and
+    of its descendants, e.g. the ffprobe calls of the probe workers, are
+    not counted.
+
+    Returns
+    -------
+    set
+        the (st_dev, st_ino) pairs of all open files, or None if there is no
+        /proc file system (e.g. on windows or mac)
+    """
+
+    if not os.path.isdir(os.path.join(proc_path, 'self', 'fd')):
+        return None
+
+    open_file_ids = set()
+
+    with metrics.timer('gopro_preflight_scan_seconds'):
+        pid_list = [pid for pid in os.listdir(proc_path) if pid.isdigit()]
+        own_pids = _get_own_pids(proc_path, pid_list)
+
+        for pid in pid_list:
+            if pid in own_pids:
+                continue
+
+            fd_path = os.path.join(proc_path, pid, 'fd')
+            try:
+                fd_list = os.listdir(fd_path)
+            except OSError:
+                # the process is gone or belongs to another user
+                continue
+
+            for fd in fd_list:
+                try:
+                    stat_result = os.stat(os.path.join(fd_path, fd))
+                except OSError:
+                    continue
+                open_file_ids.add((stat_result.st_dev, stat_result.st_ino))
+
+    return open_file_ids
+
+
+def preflight_check(rename_pattern_list, open_file_ids):
+    """ Sort the rename patterns by the state of their files.
+
+    Parameters
+    ----------
+    rename_pattern_list : list
+        [old_path, new_path] entries
+    open_file_ids : set
+        result of get_open_file_ids, None to skip the check for open files
+
+    Returns
+    -------
+    (list, list, list)
+        the patterns which can be renamed, the patterns whose file is held
+        open by another process and the patterns whose file does not exist.
+    """
+
+    ready_list = []
+    busy_list = []
+    missing_list = []
+
+    for rename_pattern in rename_pattern_list:
+        try:
+            stat_result = os.stat(rename_pattern[0])
+        except OSError:
+            missing_list.append(rename_pattern)
+            continue
+
+        if (open_file_ids is not None and
+                (stat_result.st_dev, stat_result.st_ino) in open_file_ids):
+            busy_list.append(rename_pattern)
+        else:
+            ready_list.append(rename_pattern)
+
+    return ready_list, busy_list, missing_list
+
+
+def rename_with_preflight(rename_pattern_list, retries=3, retry_delay=1.0):
+    """ Rename the files, but defer those which are still in use.
+
+    The files which are held open, e.g. by an offload tool which still
+    writes into the folder, are retried after retry_delay seconds with a
+    fresh sweep over /proc, at most retries times.
+
+    Returns
+    -------
+    (list, list)
+        the patterns which were renamed successfully and the patterns which
+        stayed busy
+    """
+
+    renamed_list = []
+    pending_list = list(rename_pattern_list)
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(retry_delay)
+
+        ready_list, pending_list, missing_list = preflight_check(pending_list,
+                                                                 get_open_file_ids())
+
+        for rename_pattern in missing_list:
+            print('File "{0}" does not exist. Nothing done.'.format(rename_pattern[0]))
+
+        for rename_pattern in ready_list:
+            if rename_filename(rename_pattern):
+                renamed_list.append(rename_pattern)
+
+        if not pending_list:
+            break
+
+    metrics.inc('gopro_files_busy_total', len(pending_list))
+    for rename_pattern in pending_list:
+        print('File "{0}" is in use by another program. Nothing '
+              'done.'.format(rename_pattern[0]))
+
+    return renamed_list, pending_list
+
+# Preflight check for files in use
+# =============================================================================
+
+
+# =============================================================================
+# Vectorized batch engine
+
+"""
+The batch engine produces the same rename patterns as search_and_rename, but
+processes all names at once with numpy instead of one regular expression per
+name. It is meant to replan whole archives with millions of names.
+
+All valid GoPro names have exactly 12 characters, so the names are loaded in
+a fixed width array of character codes and each column is checked at once
+for all names. The order of the result follows the find_* methods: the
+groups of a kind are ordered by the last position of one of their members
+in the list (the find_* methods iterate reversed) and the members of a
+group keep their position in the list.
+"""
+
+# kinds of the names in the batch engine
+_UNMATCHED = 0
+_CHAPTER = 1
+_CHAPTER_FIRST = 2
+_BURST = 3
+_RECORD_3D = 4
+_SINGLE = 5
+
+_NAME_LENGTH = 12
+
+
+def _require_numpy():
+    if np is None:
+        raise Exception('The batch engine requires numpy, which is not installed!')
+
+
+def _char_codes(text):
+    return np.array([ord(char) for char in text], dtype=np.uint32)
+
+
+def _column_is(codes, column, text):
+    """ Check for all names whether the columns from column on equal text. """
+
+    return np.all(codes[:, column:column + len(text)] == _char_codes(text), axis=1)
+
+
+def _columns_are_digits(codes, start, stop):
+    columns = codes[:, start:stop]
+    return np.all((columns >= ord('0')) & (columns <= ord('9')), axis=1)
+
+
+def _columns_to_int(codes, start, stop):
+    weights = 10 ** np.arange(stop - start - 1, -1, -1, dtype=np.int64)
+    return (codes[:, start:stop].astype(np.int64) - ord('0')) @ weights
+
+
+def load_names_batch(names):
+    """ Load names into a fixed width array of character codes.
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray)
+        the names as unicode array and a (number of names, width) array with
+        the character codes, where width is at least 13, so that the names
+        of exactly 12 characters can be told apart.
+    """
+
+    _require_numpy()
+
+    name_array = np.array(names, dtype=np.str_)
+    if name_array.dtype.itemsize // 4 < _NAME_LENGTH + 1:
+        name_array = name_array.astype('U{0}'.format(_NAME_LENGTH + 1))
+
+    width = name_array.dtype.itemsize // 4
+    codes = np.ascontiguousarray(name_array).view(np.uint32).reshape(len(name_array), width)
+
+    return name_array, codes
+
+
+def classify_names_batch(codes):
+    """ Classify all names like the find_* methods.
+
+    Parameters
+    ----------
+    codes : numpy.ndarray
+        character codes of the names from load_names_batch
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray)
+        the kind of each name and the indices of the classified names in the
+        order of search_and_rename
+    """
+
+    number_of_names = codes.shape[0]
+    position = np.arange(number_of_names, dtype=np.int64)
+
+    # the names have exactly 12 characters and end with a media extension
+    media = (codes[:, _NAME_LENGTH - 1] != 0) & (codes[:, _NAME_LENGTH] == 0)
+    media &= (_column_is(codes, 8, '.MP4') | _column_is(codes, 8, '.mp4') |
+              _column_is(codes, 8, '.JPG') | _column_is(codes, 8, '.jpg'))
+
+    chapter = media & _column_is(codes, 0, 'GP') & _columns_are_digits(codes, 2, 8)
+    burst = media & _column_is(codes, 0, 'G') & _columns_are_digits(codes, 1, 8)
+    record_3d = (media & _column_is(codes, 0, '3D_') &
+                 ((codes[:, 3] == ord('L')) | (codes[:, 3] == ord('R'))) &
+                 _columns_are_digits(codes, 4, 8))
+    single = media & _column_is(codes, 0, 'GOPR') & _columns_are_digits(codes, 4, 8)
+
+    file_number = _columns_to_int(codes, 4, 8)
+
+    # the first video of a chaptered video has to be 'GOPR<zzzz>.MP4'
+    chapter_numbers = np.unique(file_number[chapter])
+    chapter_first = (single & _column_is(codes, 8, '.MP4') &
+                     np.isin(file_number, chapter_numbers))
+    single &= ~chapter_first
+
+    kind = np.full(number_of_names, _UNMATCHED, dtype=np.int8)
+    kind[chapter] = _CHAPTER
+    kind[chapter_first] = _CHAPTER_FIRST
+    kind[burst] = _BURST
+    kind[record_3d] = _RECORD_3D
+    kind[single] = _SINGLE
+
+    order_list = []
+
+    # chaptered videos, the group order is only given by the chapters GP<xx>
+    members = np.flatnonzero(chapter | chapter_first)
+    group_key = file_number[members]
+    order_list.append(_order_groups(members, group_key, chapter[members],
+                                    np.where(chapter_first[members], -1, members)))
+
+    # burst items, grouped by <yyy>
+    members = np.flatnonzero(burst)
+    order_list.append(_order_groups(members, _columns_to_int(codes[members], 1, 4),
+                                    np.ones(len(members), dtype=bool), members))
+
+    # 3D records, the left ones first and then the right ones reversed, like
+    # the insert and append in find_3d_records
+    members = np.flatnonzero(record_3d)
+    left = codes[members, 3] == ord('L')
+    order_list.append(_order_groups(members, file_number[members],
+                                    np.ones(len(members), dtype=bool),
+                                    np.where(left, members, 2 * number_of_names - members)))
+
+    order_list.append(position[single])
+
+    return kind, np.concatenate(order_list)
+
+
+def _order_groups(members, group_key, defines_group, member_key):
+    """ Order the members of a kind by group and inside of a group.
+
+    Parameters
+    ----------
+    members : numpy.ndarray
+        positions of the names in the list
+    group_key : numpy.ndarray
+        the group of each member
+    defines_group : numpy.ndarray
+        members whose position counts for the order of the groups
+    member_key : numpy.ndarray
+        the order of the members inside of a group
+
+    Returns
+    -------
+    numpy.ndarray
+        the members in the order of the find_* and map_* methods
+    """
+
+    if not len(members):
+        return members
+
+    unique_keys, group_index = np.unique(group_key, return_inverse=True)
+
+    last_position = np.full(len(unique_keys), -1, dtype=np.int64)
+    np.maximum.at(last_position, group_index[defines_group], members[defines_group])
+
+    return members[np.lexsort((member_key, -last_position[group_index]))]
+
+
+def format_timestamps_batch(timestamps):
+    """ Format timestamps as character codes of '%Y-%m-%d_%Hh%Mm%Ss'.
+
+    Parameters
+    ----------
+    timestamps : array_like
+        values which can be converted to numpy.datetime64
+
+    Returns
+    -------
+    numpy.ndarray
+        a (number of timestamps, 20) array with the character codes
+    """
+
+    _require_numpy()
+
+    iso_strings = np.datetime_as_string(np.asarray(timestamps, dtype='datetime64[s]'),
+                                        unit='s')
+    iso_codes = np.ascontiguousarray(iso_strings.astype('U19')).view(np.uint32).reshape(-1, 19)
+
+    # 'YYYY-MM-DDThh:mm:ss' ===> 'YYYY-MM-DD_hhhmmmsss'
+    return _join_columns(len(iso_codes), [iso_codes[:, 0:10], '_', iso_codes[:, 11:13],
+                                          'h', iso_codes[:, 14:16], 'm',
+                                          iso_codes[:, 17:19], 's'])
+
+
+def _join_columns(number_of_rows, pieces):
+    """ Join columns of character codes and constant strings to a new array. """
+
+    columns = []
+    for piece in pieces:
+        if isinstance(piece, str):
+            piece = np.broadcast_to(_char_codes(piece), (number_of_rows, len(piece)))
+        columns.append(piece)
+
+    return np.concatenate(columns, axis=1)
+
+
+def _codes_to_strings(codes):
+    return np.ascontiguousarray(codes).view('U{0}'.format(codes.shape[1])).ravel()
+
+
+def render_names_batch(codes, kind, date_codes, order):
+    """ Render the new names of the classified names in bulk.
+
+    Parameters
+    ----------
+    codes : numpy.ndarray
+        character codes of the names from load_names_batch
+    kind : numpy.ndarray
+        kinds from classify_names_batch
+    date_codes : numpy.ndarray
+        the formatted creation dates from format_timestamps_batch
+    order : numpy.ndarray
+        the indices of the names to render
+
+    Returns
+    -------
+    numpy.ndarray
+        the new names in the given order
+    """
+
+    new_names = np.empty(len(order), dtype='U33')
+    selected_kind = kind[order]
+
+    formats = {
+        # <date>_<xx>_<zzzz>.<ext>
+        _CHAPTER: lambda c: ['_', c[:, 2:4], '_', c[:, 4:8], c[:, 8:12]],
+        # <date>_00_<zzzz>.<ext>
+        _CHAPTER_FIRST: lambda c: ['_00_', c[:, 4:8], c[:, 8:12]],
+        # <date>_<yyy>_<zzzz>.<ext>
+        _BURST: lambda c: ['_', c[:, 1:4], '_', c[:, 4:8], c[:, 8:12]],
+        # <date>_<zzzz>_<D>.<ext>
+        _RECORD_3D: lambda c: ['_', c[:, 4:8], '_', c[:, 3:4], c[:, 8:12]],
+        # <date>_<zzzz>.<ext>
+        _SINGLE: lambda c: ['_', c[:, 4:8], c[:, 8:12]],
+    }
+
+    for name_kind, name_format in formats.items():
+        selection = np.flatnonzero(selected_kind == name_kind)
+        if not len(selection):
+            continue
+
+        name_codes = codes[order[selection]]
+        pieces = [date_codes[order[selection]]] + name_format(name_codes)
+        new_names[selection] = _codes_to_strings(_join_columns(len(selection), pieces))
+
+    return new_names
+
+
+def search_and_rename_batch(names, timestamps):
+    """ Vectorized version of search_and_rename.
+
+    The names have to be unique, like the entries of a folder. A list with a
+    name twice raises an Exception, since search_and_rename would treat the
+    two copies as different files.
+
+    Parameters
+    ----------
+    names : list
+        the filenames, e.g. of a folder
+    timestamps : array_like
+        the creation date of each name, e.g. as datetime or datetime64.
+        The dates of names which are not renamed are ignored.
+
+    Returns
+    -------
+    list
+        [old_name, new_name] entries in the same order as search_and_rename
+    """
+
+    name_array, codes = load_names_batch(names)
+
+    unique_names, counts = np.unique(name_array, return_counts=True)
+    if np.any(counts > 1):
+        raise Exception('The batch engine requires unique names, but got {0} more '
+                        'than once!'.format(unique_names[counts > 1].tolist()))
+
+    kind, order = classify_names_batch(codes)
+    new_names = render_names_batch(codes, kind, format_timestamps_batch(timestamps), order)
+
+    return [list(pattern) for pattern in zip(name_array[order].tolist(), new_names.tolist())]
+
+
+def benchmark_batch_engine(number_of_groups=20000, seed=0, **layout):
+    """ Compare the batch engine with search_and_rename on generated cards.
+
+    The names of each folder from iter_rnd_card_groups are shuffled, since a
+    folder listing has no particular order, and get random creation dates.
+    Both engines have to produce identical rename patterns.
+
+    Returns
+    -------
+    dict
+        the number of names and the runtime in seconds of both engines
+    """
+
+    _require_numpy()
+
+    rng = random.Random(seed)
+    result = {'names': 0, 'python_seconds': 0.0, 'numpy_seconds': 0.0}
+
+    folder_dict = {}
+    for folder, name in iter_rnd_card_names(number_of_groups, seed=seed, **layout):
+        folder_dict.setdefault(folder, []).append(name)
+
+    for folder, names in folder_dict.items():
+        rng.shuffle(names)
+        timestamps = [datetime.datetime(2018, 1, 1) +
+                      datetime.timedelta(seconds=rng.randrange(365 * 24 * 3600))
+                      for name in names]
+        date_dict = {name: timestamp.strftime('%Y-%m-%d_%Hh%Mm%Ss')
+                     for name, timestamp in zip(names, timestamps)}
+
+        start = time.perf_counter()
+        python_patterns = search_and_rename(
+            list(names), date_getter=lambda path: date_dict[os.path.basename(path)])
+        result['python_seconds'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        numpy_patterns = search_and_rename_batch(names, timestamps)
+        result['numpy_seconds'] += time.perf_counter() - start
+
+        if python_patterns != numpy_patterns:
+            raise Exception('The batch engine differs from search_and_rename '
+                            'in folder "{0}"!'.format(folder))
+
+        result['names'] += len(names)
+
+    return result
+
+# Vectorized batch engine
+# =============================================================================
+
+
+# =============================================================================
+# Pipelined rename engine
+
+# marker which is passed down the queues once a stage has no more work
+_END_OF_STREAM = object()
+
+# seconds after which the set of open files is collected again
+PREFLIGHT_MAX_AGE = 1.0
+
+
+def map_group(kind, names, directory='.', date_getter=None):
+    """ Create the rename patterns for a single group of files.
+
+    Parameters
+    ----------
+    kind : str
+        one of CHAPTERED, BURST, RECORD_3D or SINGLE
+    names : list
+        the filenames of the group as collected by the find_* methods
+    directory : str
+        the folder in which the files are located
+    date_getter : function
+        returns the formatted creation date of a path, by default
+        get_date_taken
+
+    Returns
+    -------
+    list
+        a list of [old_name, new_name] entries for the group
+    """
+
+    if kind == CHAPTERED:
+        return map_chaptered_videos({None: names}, [], directory, date_getter)
+    elif kind == BURST:
+        return map_burst_items({None: names}, [], directory, date_getter)
+    elif kind == RECORD_3D:
+        return map_3d_records({None: names}, [], directory, date_getter)
+    elif kind == SINGLE:
+        return map_single_items(names, [], directory, date_getter)
+
+    raise Exception('Unknown group kind "{0}" was given!'.format(kind))
+
+
+class RenamePipeline:
+    """ Run scan, classify, probe and rename as concurrent stages.
+
+    Each stage runs in its own thread and hands its work to the next stage
+    via a bounded queue, so a slow stage throttles the stages in front of it
+    instead of letting the pending work grow without limit. The metadata
+    probing is done by several workers, since it is dominated by waiting on
+    ffprobe and on the disk.
+
+    Complete groups flow directly to the renamer, which renames a group
+    always as a whole. A call to cancel() stops the pipeline after the group
+    which is currently renamed, so that no series is left half renamed.
+
+    Before a group is probed and again before it is renamed, it is checked
+    against the files which are held open by other processes, see
+    get_open_file_ids. Busy groups, and groups whose probe failed while one
+    of their files was in use, are deferred and probed and renamed again at
+    the end of the run.
+
+    The groups are probed in the order of their position on the disk to
+    reduce the seeking of hard disks and slow card readers, see
+    order_by_physical_layout.
+
+    Note that the classification can only emit its groups after the scan
+    has finished, because a 'GOPR<zzzz>.MP4' file is only known to be the
+    first part of a chaptered video or a single video once all the files of
+    the folder are known.
+    """
+
+    def __init__(self, directory, probe_workers=4, queue_size=64, dryrun=False,
+                 physical_order=True, date_getter=None, preflight=True,
+                 retries=3, retry_delay=1.0):
+        """
+        Parameters
+        ----------
+        directory : str
+            the folder with the GoPro files
+        probe_workers : int
+            number of threads which extract the creation dates
+        queue_size : int
+            maximal number of pending items between two stages
+        dryrun : bool
+            only collect the rename patterns without renaming the files
+        physical_order : bool
+            probe the groups in the order of their layout on the disk and
+            announce the upcoming reads to the kernel
+        date_getter : function
+            returns the formatted creation date of a path, e.g.
+            get_date_taken_gps to correct the camera clock by GPS, which
+            gets the clock offsets of this run from clock_offset_cache
+        preflight : bool
+            defer the groups with files which are in use by other programs
+        retries : int
+            how often the deferred groups are retried
+        retry_delay : float
+            seconds to wait before the deferred groups are retried
+        """
+
+        # without a probe worker or queue space the stages would wait forever
+        if probe_workers < 1:
+            raise Exception('At least one probe worker is needed, but {0} was '
+                            'given!'.format(probe_workers))
+        if queue_size < 1:
+            raise Exception('The queues need a size of at least 1, but {0} was '
+                            'given!'.format(queue_size))
+
+        self.directory = directory
+        self.probe_workers = probe_workers
+        self.dryrun = dryrun
+        self.physical_order = physical_order
+        self.date_getter = date_getter
+
+        # the offsets are only valid for the cards of this run
+        self.clock_offset_cache = ClockOffsetCache()
+        if date_getter is get_date_taken_gps:
+            self.date_getter = lambda path: get_date_taken_gps(path, self.clock_offset_cache)
+        self.preflight = preflight
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._open_file_ids = None
+        self._open_file_ids_time = None
+        self._open_file_ids_lock = threading.Lock()
+        self._busy_group_lock = threading.Lock()
+
+        self._name_queue = queue.Queue(maxsize=queue_size)
+        self._group_queue = queue.Queue(maxsize=queue_size)
+        self._rename_queue = queue.Queue(maxsize=queue_size)
+
+        self._cancel_event = threading.Event()
+        self._threads = []
+
+        # the first exception raised in one of the stages
+        self._error = None
+        self._error_lock = threading.Lock()
+
+        self.rename_pattern_list = []
+        self.remaining_list = []
+        # the (kind, names) of the groups which stayed in use
+        self.busy_group_list = []
+
+    def cancel(self):
+        """ Request to stop the pipeline after the current group. """
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def start(self):
+        """ Start all the stages in their own threads. """
+
+        stage_list = [self._scan_stage, self._classify_stage, self._rename_stage]
+        stage_list.extend([self._probe_stage] * self.probe_workers)
+
+        self._threads = [threading.Thread(target=self._run_stage, args=(stage,))
+                         for stage in stage_list]
+
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def join(self):
+        """ Wait until all the stages are finished.
+
+        Returns
+        -------
+        list
+            the [old_name, new_name] patterns of the renamed groups
+
+        Raises
+        ------
+        Exception
+            the first exception which was raised in one of the stages, the
+            pipeline is cancelled in this case
+        """
+
+        for thread in self._threads:
+            thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+        return self.rename_pattern_list
+
+    def run(self):
+        """ Run the complete pipeline and wait for its end. """
+        self.start()
+        return self.join()
+
+    def _run_stage(self, stage):
+        """ Run a stage and cancel the pipeline if the stage fails. """
+
+        try:
+            stage()
+        except Exception as exp:
+            with self._error_lock:
+                if self._error is None:
+                    self._error = exp
+            # the other stages would otherwise wait forever for this one
+            self.cancel()
+
+    def _put(self, work_queue, item):
+        """ Put an item in a queue, but give up if the run is cancelled. """
+
+        while not self.cancelled:
+            try:
+                work_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _get(self, work_queue):
+        """ Get the next item of a queue or _END_OF_STREAM if cancelled. """
+
+        while not self.cancelled:
+            try:
+                return work_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        return _END_OF_STREAM
+
+    def _scan_stage(self):
+
+        # the time to read the folder and the time blocked by the classify
+        # stage are measured apart, to tell a slow card reader from a slow
+        # downstream stage
+        scan_seconds = 0.0
+        queue_wait_seconds = 0.0
+
+        try:
+            start = time.perf_counter()
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    metrics.inc('gopro_files_scanned_total')
+
+                    put_start = time.perf_counter()
+                    scan_seconds += put_start - start
+                    if not self._put(self._name_queue, entry.name):
+                        return
+                    start = time.perf_counter()
+                    queue_wait_seconds += start - put_start
+
+            scan_seconds += time.perf_counter() - start
+        finally:
+            metrics.observe('gopro_scan_seconds', scan_seconds)
+            metrics.observe('gopro_scan_queue_wait_seconds', queue_wait_seconds)
+            self._put(self._name_queue, _END_OF_STREAM)
+
+    def _classify_stage(self):
+
+        filelist = []
+
+        try:
+            while True:
+                name = self._get(self._name_queue)
+                if name is _END_OF_STREAM:
+                    break
+                filelist.append(name)
+
+            if self.cancelled:
+                return
+
+            with metrics.timer('gopro_classify_seconds'):
+                filelist, chap_vid_group_dict = find_chaptered_videos(filelist, {})
+                filelist, burst_time_lapsed_dict = find_burst_items(filelist, {})
+                filelist, record_3d_dict = find_3d_records(filelist, {})
+                filelist, single_element_list = find_single_items(filelist, [])
+
+            self.remaining_list = filelist
+            metrics.inc('gopro_files_unmatched_total', len(filelist))
+
+            group_list = [(CHAPTERED, names) for names in chap_vid_group_dict.values()]
+            group_list.extend((BURST, names) for names in burst_time_lapsed_dict.values())
+            group_list.extend((RECORD_3D, names) for names in record_3d_dict.values())
+            group_list.extend((SINGLE, [name]) for name in single_element_list)
+            metrics.inc('gopro_groups_classified_total', len(group_list))
+
+            if self.physical_order:
+                # the latency of the reader is hidden by several workers
+                group_list = order_by_physical_layout(
+                    group_list,
+                    get_paths=lambda group: [os.path.join(self.directory, name)
+                                             for name in group[1]],
+                    workers=self.probe_workers)
+
+            for group in group_list:
+                # files which are still written cannot be probed reliably
+                if self._is_busy(group[1]):
+                    self._defer_group(group)
+                    continue
+
+                # the queue holds the groups back, so the hints are only
+                # issued shortly before the probes arrive at the files
+                if self.physical_order:
+                    advise_readahead([os.path.join(self.directory, name)
+                                      for name in group[1]])
+
+                if not self._put(self._group_queue, group):
+                    return
+
+        finally:
+            # every probe worker needs its own end marker
+            for ii in range(self.probe_workers):
+                self._put(self._group_queue, _END_OF_STREAM)
+
+    def _probe_stage(self):
+
+        try:
+            while True:
+                group = self._get(self._group_queue)
+                if group is _END_OF_STREAM:
+                    break
+
+                rename_patterns = self._probe_group(group)
+                if rename_patterns is None:
+                    continue
+
+                if not self._put(self._rename_queue,
+                                 (group, rename_patterns, time.monotonic())):
+                    break
+        finally:
+            self._put(self._rename_queue, _END_OF_STREAM)
+
+    def _rename_stage(self):
+
+        finished_workers = 0
+
+        while finished_workers < self.probe_workers:
+
+            # all the groups which are ready are taken at once, so that they
+            # share one sweep over /proc after the end of their probes
+            item_list = [self._get(self._rename_queue)]
+            while not self.cancelled:
+                try:
+                    item_list.append(self._rename_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for item in item_list:
+
+                # a cancel request is only checked between groups
+                if self.cancelled:
+                    return
+
+                if item is _END_OF_STREAM:
+                    finished_workers += 1
+                    continue
+
+                group, rename_patterns, probe_time = item
+                if not self._rename_group(rename_patterns, probe_time):
+                    self._defer_group(group)
+
+        self._retry_busy_groups()
+
+    def _get_open_file_ids(self, not_before=None):
+        """ Return the open files of the last /proc sweep, if it is recent.
+
+        A sweep is also repeated if it was started before the monotonic time
+        not_before, e.g. before the probe of a group was finished.
+        """
+
+        with self._open_file_ids_lock:
+            now = time.monotonic()
+            if (self._open_file_ids_time is None or
+                    now - self._open_file_ids_time > PREFLIGHT_MAX_AGE or
+                    (not_before is not None and self._open_file_ids_time < not_before)):
+                self._open_file_ids = get_open_file_ids()
+                # the sweep only covers the files opened before its start
+                self._open_file_ids_time = now
+
+            return self._open_file_ids
+
+    def _is_busy(self, names, not_before=None):
+        """ Check whether a file of the group is held open by another process. """
+
+        if not self.preflight:
+            return False
+
+        path_patterns = [[os.path.join(self.directory, name)] * 2 for name in names]
+        ready_list, busy_list, missing_list = preflight_check(
+            path_patterns, self._get_open_file_ids(not_before))
+        return bool(busy_list)
+
+    def _defer_group(self, group):
+        with self._busy_group_lock:
+            self.busy_group_list.append(group)
+
+    def _probe_group(self, group):
+        """ Return the rename patterns of a group or None if the probe failed.
+
+        A group whose probe failed while one of its files is in use, e.g. a
+        video whose 'moov' atom is not yet written, is deferred.
+        """
+
+        kind, names = group
+
+        try:
+            with metrics.timer('gopro_group_probe_seconds', kind=kind):
+                return map_group(kind, names, self.directory, self.date_getter)
+        except Exception as exp:
+            metrics.inc('gopro_probe_errors_total')
+            if self._is_busy(names):
+                self._defer_group(group)
+                return None
+
+            print('Cannot extract the creation date of the group {0}. '
+                  'The following error occured: {1}'.format(names, exp))
+            return None
+
+    def _rename_group(self, rename_patterns, probe_time=None):
+        """ Rename a group as a whole, return False if a file is in use.
+
+        The check for files in use relies on a sweep over /proc which was
+        started after probe_time, the end of the probe of the group.
+        """
+
+        path_patterns = [[os.path.join(self.directory, rename_pattern[0]),
+                          os.path.join(self.directory, rename_pattern[1])]
+                         for rename_pattern in rename_patterns]
+
+        if not self.dryrun:
+            # a file may have been opened again since it was probed
+            if self._is_busy([rename_pattern[0] for rename_pattern in rename_patterns],
+                             not_before=probe_time):
+                return False
+
+            for path_pattern in path_patterns:
+                rename_filename(path_pattern)
+
+        self.rename_pattern_list.extend(rename_patterns)
+        return True
+
+    def _retry_busy_groups(self):
+
+        for attempt in range(self.retries):
+            if not self.busy_group_list:
+                break
+
+            # waits also return early on a cancel request
+            if self._cancel_event.wait(self.retry_delay):
+                return
+
+            # force a fresh sweep over /proc
+            self._open_file_ids_time = None
+
+            # all the other stages are finished at this point
+            busy_group_list = self.busy_group_list
+            self.busy_group_list = []
+            for group in busy_group_list:
+                if self._is_busy(group[1]):
+                    self.busy_group_list.append(group)
+                    continue
+
+                rename_patterns = self._probe_group(group)
+                if (rename_patterns is not None and
+                        not self._rename_group(rename_patterns, time.monotonic())):
+                    self.busy_group_list.append(group)
+
+        for kind, names in self.busy_group_list:
+            metrics.inc('gopro_files_busy_total', len(names))
+            print('The group {0} is in use by another program. Nothing '
+                  'done.'.format(names))
+
+
+def run_rename_pipeline(directory, probe_workers=4, queue_size=64, dryrun=False,
+                        physical_order=True, date_getter=None, preflight=True,
+                        retries=3, retry_delay=1.0):
+    """ Rename all GoPro files of a folder with the pipelined engine.
+
+    Returns
+    -------
+    list
+        the [old_name, new_name] patterns of the renamed groups
+    """
+
+    pipeline = RenamePipeline(directory, probe_workers=probe_workers,
+                              queue_size=queue_size, dryrun=dryrun,
+                              physical_order=physical_order,
+                              date_getter=date_getter,
+                              preflight=preflight, retries=retries,
+                              retry_delay=retry_delay)
+    return pipeline.run()
+
+# Pipelined rename engine
+# =============================================================================
+
+
+# =============================================================================
+# Multi-camera timeline
+
+def add_camera_suffix(filename, camera_id):
+    """ Attach the camera identity to a new filename.
+
+        <YYYY>-<MM>-<DD>_<hh>H-<mm>m-<ss>s_<...>.<ext> ===> <YYYY>-<MM>-<DD>_<hh>H-<mm>m-<ss>s_<...>_<camera_id>.<ext>
+    """
+
+    root, ext = os.path.splitext(filename)
+    return '{0}_{1}{2}'.format(root, camera_id, ext)
+
+
+def iter_camera_plan(directory, **pipeline_options):
+    """ Plan the renaming of a single camera folder sorted by time.
+
+    Since the new names start with the creation date, sorting them by name
+    sorts them in time. The complete plan of the folder is kept in memory,
+    the pipeline produces the groups in the order of the disk, not of time.
+
+    Returns
+    -------
+    generator
+        yielding [old_name, new_name] entries in the order of the new names
+    """
+
+    pipeline_options['dryrun'] = True
+    rename_pattern_list = run_rename_pipeline(directory, **pipeline_options)
+    rename_pattern_list.sort(key=lambda rename_pattern: rename_pattern[1])
+
+    for rename_pattern in rename_pattern_list:
+        yield rename_pattern
+
+
+def merge_camera_plans(camera_plans):
+    """ Merge the time sorted plans of several cameras into a single timeline.
+
+    This is a k-way merge over a heap with the next entry of each camera,
+    so merging k cameras with n files in total takes O(n log k) time. The
+    memory is only bounded by the plans themselves: the merge starts all of
+    them at once, so plans from iter_camera_plan are all in memory together.
+    Files of the same time keep the order in which the cameras are given.
+
+    Parameters
+    ----------
+    camera_plans : list
+        pairs of (camera_id, plan), where plan is an iterable of
+        [old_name, new_name] entries sorted by new_name
+
+    Returns
+    -------
+    generator
+        yielding (camera_id, old_name, new_name) in the order of new_name.
+        The new_name does not yet contain the camera identity.
+    """
+
+    def tag_plan(camera_id, plan):
+        for old_name, new_name in plan:
+            yield camera_id, old_name, new_name
+
+    streams = [tag_plan(camera_id, plan) for camera_id, plan in camera_plans]
+
+    return heapq.merge(*streams, key=lambda entry: entry[2])
+
+
+def merge_camera_roots(camera_roots, target_directory=None, **pipeline_options):
+    """ Plan a common timeline for the folders of several cameras.
+
+    Parameters
+    ----------
+    camera_roots : list
+        pairs of (camera_id, directory), the camera_id is appended to each
+        new filename to keep the files of the cameras apart and has to be
+        unique
+    target_directory : str
+        folder in which the renamed files are placed, by default each file
+        stays in the folder of its camera. The files are moved by a rename,
+        so the folder has to be on the same file system as the cameras.
+
+    Returns
+    -------
+    generator
+        yielding [old_path, new_path] entries in the order of the timeline
+    """
+
+    camera_roots = list(camera_roots)
+    camera_directories = {}
+    for camera_id, directory in camera_roots:
+        if camera_id in camera_directories:
+            raise Exception('The camera id "{0}" was given twice!'.format(camera_id))
+        camera_directories[camera_id] = directory
+
+        # a rename cannot move a file to another device, e.g. from a card
+        if (target_directory is not None and
+                os.stat(target_directory).st_dev != os.stat(directory).st_dev):
+            raise Exception('The folder "{0}" of camera "{1}" is not on the file '
+                            'system of "{2}"!'.format(directory, camera_id,
+                                                      target_directory))
+
+    camera_plans = [(camera_id, iter_camera_plan(directory, **pipeline_options))
+                    for camera_id, directory in camera_roots]
+
+    for camera_id, old_name, new_name in merge_camera_plans(camera_plans):
+
+        directory = camera_directories[camera_id]
+        if target_directory is not None:
+            new_directory = target_directory
+        else:
+            new_directory = directory
+
+        yield [os.path.join(directory, old_name),
+               os.path.join(new_directory, add_camera_suffix(new_name, camera_id))]
+
+
+def run_multi_camera_rename(camera_roots, target_directory=None, dryrun=False,
+                            **pipeline_options):
+    """ Rename the files of several cameras into a common timeline.
+
+    The files which are in use by other programs are deferred and retried,
+    see rename_with_preflight, with the retries and retry_delay of the
+    pipeline_options.
+
+    Returns
+    -------
+    list
+        the [old_path, new_path] patterns which were renamed, in the order
+        of the timeline for a dryrun
+    """
+
+    rename_pattern_list = list(merge_camera_roots(camera_roots, target_directory,
+                                                  **pipeline_options))
+    if dryrun:
+        return rename_pattern_list
+
+    renamed_list, busy_list = rename_with_preflight(
+        rename_pattern_list, retries=pipeline_options.get('retries', 3),
+        retry_delay=pipeline_options.get('retry_delay', 1.0))
+
+    return renamed_list
+
+# Multi-camera timeline
+# =============================================================================
+
+
+if __name__ == '__main__':
+
+#    extract_from_files(test_file_list)
+    
+#    print(gen_rnd_file_list())
+#    print(gen_rnd_chap_list(number_of_files=10))
+#    print(gen_rnd_burst_loop_list())
+    
+    folderpath = os.path.abspath(r'C:\Users\AlexS\Desktop\test2')
+    print(folderpath)
+    
+    rename_pattern_list = run_rename_pipeline(folderpath)
+    print(rename_pattern_list)
     
     
     